@@ -1,13 +1,12 @@
-import argparse
+import functools
 import os
-from dataclasses import dataclass, fields
+import sys
+from dataclasses import MISSING, dataclass, fields, replace
 
 from dotenv import load_dotenv
 
 import constants
 from storage import Storage
-from storage.filesystem import FilesystemStorage
-from storage.s3 import S3Storage
 from utils import get_logger
 
 
@@ -16,7 +15,7 @@ logger = get_logger()
 _storage_backend: Storage
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Config:
     spotify_token_url: str
     spotify_client_id: str
@@ -32,18 +31,25 @@ class Config:
     s3_secret_access_key: str
     check_interval: int = 60
 
+    @classmethod
+    def from_env(cls, env: dict) -> "Config":
+        return cls(*(env.get(env_var, default) for env_var, default in _CONFIG_ENV_VARS))
 
-def _from_dict(dict_: dict) -> Config:
-    dict_ = {k.lower(): v for k, v in dict_.items()}
-    return Config(**dict_)
+
+_CONFIG_FIELD_NAMES = tuple(f.name for f in fields(Config))
+_CONFIG_ENV_VARS = tuple((f.name.upper(), None if f.default is MISSING else f.default) for f in fields(Config))
 
 
 def set_storage_backend(config: Config) -> Storage:
     global _storage_backend
     match config.storage_backend:
         case "s3":
+            from storage.s3 import S3Storage
+
             _storage_backend = S3Storage(config=config)
         case "filesystem":
+            from storage.filesystem import FilesystemStorage
+
             _storage_backend = FilesystemStorage(config=config)
         case _:
             raise ValueError("Invalid storage backend")
@@ -61,25 +67,42 @@ def _raise_missing_config_value_error(f_name: str):
     exit(1)
 
 
+def _parse_cli_args(argv: list[str]) -> dict:
+    cli_args = {}
+    args = iter(argv)
+    for arg in args:
+        if not arg.startswith("--"):
+            logger.error(f"Unexpected argument: {arg}")
+            exit(1)
+        name, separator, value = arg[2:].partition("=")
+        if name not in _CONFIG_FIELD_NAMES:
+            logger.error(f"Unknown argument: --{name}")
+            exit(1)
+        if not separator:
+            value = next(args, None)
+            if value is None:
+                logger.error(f"The argument --{name} expects a value")
+                exit(1)
+        cli_args[name] = value
+    return cli_args
+
+
+@functools.lru_cache(maxsize=1)
 def load_config() -> Config:
     logger.info("Loading configuration...")
     load_dotenv()
-    parser = argparse.ArgumentParser()
-    for f in fields(Config):
-        f_name = f.name
-        parser.add_argument(f"--{f_name}", default=os.getenv(f_name.upper()))
-    args = parser.parse_args()
-    config_dict = {f.name: getattr(args, f.name) for f in fields(Config)}
-    config = _from_dict(config_dict)
+    env = os.environ.copy()
+    env.update((name.upper(), value) for name, value in _parse_cli_args(sys.argv[1:]).items())
+    config = Config.from_env(env)
     storage_storage_info_msg = ""
     if config.storage_backend is None:
         logger.warning("No storage backend provided, using the filesystem storage backend")
-        config.storage_backend = constants.STORAGE_FILESYSTEM
+        config = replace(config, storage_backend=constants.STORAGE_FILESYSTEM)
     else:
         match config.storage_backend:
             case constants.STORAGE_FILESYSTEM:
                 if config.filesystem_storage_path is None:
-                    config.filesystem_storage_path = os.getcwd()
+                    config = replace(config, filesystem_storage_path=os.getcwd())
                     logger.warning(f"No storage path provided, using the current directory: {config.filesystem_storage_path}")
                 storage_storage_info_msg = f"Storage path set to: {config.filesystem_storage_path}"
             case constants.STORAGE_S3:
@@ -102,3 +125,7 @@ def load_config() -> Config:
     logger.info(f"Storage backend is set to: {config.storage_backend}")
     logger.info(storage_storage_info_msg)
     return config
+
+
+def get_config() -> Config:
+    return load_config()
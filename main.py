@@ -1,20 +1,26 @@
 import asyncio
+import functools
 import time
+from dataclasses import dataclass
 
-import nest_asyncio
-import requests
-from telegram import Bot
+import httpx
+import orjson
+from telegram.ext import AIORateLimiter, ExtBot
 from telegram.request import HTTPXRequest
 
-from config import Config, get_storage_backend, load_config
-from storage import FileNotFound, StorageData
+from config import Config, get_config, get_storage_backend
+from storage import FileNotFound, Storage, StorageData
 from utils import get_logger, sanitize_text
 
 
 logger = get_logger()
 
 ACCESS_TOKEN = "access_token"
+EXPIRES_IN = "expires_in"
 AUTH_HEADER = "Authorization"
+ETAG_HEADER = "ETag"
+IF_NONE_MATCH_HEADER = "If-None-Match"
+RETRY_AFTER_HEADER = "Retry-After"
 HTTP_STATUS_CODE = "HTTPStatusCode"
 RESPONSE_METADATA = "ResponseMetadata"
 TRACK = "track"
@@ -23,8 +29,14 @@ ARTISTS = "artists"
 ITEMS = "items"
 ADDED_BY = "added_by"
 DISPLAY_NAME = "display_name"
+SNAPSHOT_ID = "snapshot_id"
+FIELDS = "fields"
+PLAYLIST_SUMMARY = "playlist_summary"
+TOTAL = "total"
+LIMIT = "limit"
+OFFSET = "offset"
 
-config: Config = load_config()
+config: Config = get_config()
 
 spotify_playlist_url = f"https://api.spotify.com/v1/playlists/{config.spotify_playlist_id}"
 
@@ -33,118 +45,315 @@ SPOTIFY = "spotify"
 NAME = "name"
 ID = "id"
 EXTERNAL_URLS = "external_urls"
+PLAYLIST_SUMMARY_FIELDS = f"{NAME},{SNAPSHOT_ID}"
+PLAYLIST_ITEMS_FIELDS = f"{ITEMS}({ADDED_BY}.{ID},{TRACK}({ID},{NAME},{EXTERNAL_URLS},{ARTISTS}({NAME})))"
+PLAYLIST_FIELDS = f"{NAME},{ID},{SNAPSHOT_ID},{EXTERNAL_URLS},{TRACKS}({LIMIT},{TOTAL},{PLAYLIST_ITEMS_FIELDS})"
 
 telegram_request = HTTPXRequest(connection_pool_size=20, connect_timeout=30)
-bot = Bot(token=config.bot_token, request=telegram_request)
+telegram_rate_limiter = AIORateLimiter(overall_max_rate=30, overall_time_period=1, group_max_rate=20, group_time_period=60, max_retries=3)
+bot = ExtBot(token=config.bot_token, request=telegram_request, rate_limiter=telegram_rate_limiter)
+
+TOKEN = "token"
+EXPIRES_AT = "expires_at"
+TOKEN_EXPIRY_MARGIN = 60
+TOKEN_REFRESH_RETRY_INTERVAL = 30
+USER_CACHE_TTL = 86400
+SPOTIFY_MAX_CONCURRENT_PAGE_REQUESTS = 8
+SPOTIFY_RATE_LIMIT_RETRIES = 5
+SPOTIFY_DEFAULT_RETRY_AFTER = 1
+
+_token_cache = {TOKEN: None, EXPIRES_AT: 0.0}
+_token_lock = asyncio.Lock()
+_spotify_pages_semaphore = asyncio.Semaphore(SPOTIFY_MAX_CONCURRENT_PAGE_REQUESTS)
+_users_cache: dict[str, tuple[float, dict]] = {}
+_last_snapshot_id: str | None = None
+_playlist_summary_cache = {ETAG_HEADER: None, PLAYLIST_SUMMARY: None}
+
+spotify_client = httpx.AsyncClient(http2=True, timeout=30, limits=httpx.Limits(max_connections=20, max_keepalive_connections=20))
 
 
 async def send_notification(message: str, chat_id: str = config.target_chat_id, parse_mode: str = MARKDOWN_V2):
     await bot.send_message(chat_id=chat_id, text=message, parse_mode=parse_mode)
 
 
-def _make_spotify_request_headers(client_id: str = config.spotify_client_id, client_secret: str = config.spotify_client_secret) -> dict:
+async def _refresh_spotify_token(client_id: str = config.spotify_client_id, client_secret: str = config.spotify_client_secret) -> None:
     body = {"grant_type": "client_credentials"}
-    token_response = requests.post(url=config.spotify_token_url, data=body, auth=(client_id, client_secret))
-    access_token = token_response.json()[ACCESS_TOKEN]
-    headers = {AUTH_HEADER: f"Bearer {access_token}"}
+    token_response = await spotify_client.post(url=config.spotify_token_url, data=body, auth=(client_id, client_secret))
+    token_response.raise_for_status()
+    token_response_data = orjson.loads(token_response.content)
+    _token_cache[TOKEN] = token_response_data[ACCESS_TOKEN]
+    _token_cache[EXPIRES_AT] = time.monotonic() + token_response_data[EXPIRES_IN] - TOKEN_EXPIRY_MARGIN
+
+
+async def _make_spotify_request_headers() -> dict:
+    if time.monotonic() >= _token_cache[EXPIRES_AT]:
+        async with _token_lock:
+            if time.monotonic() >= _token_cache[EXPIRES_AT]:
+                await _refresh_spotify_token()
+    headers = {AUTH_HEADER: f"Bearer {_token_cache[TOKEN]}"}
     return headers
 
 
-def get_spotify_playlist(
-    client_id: str = config.spotify_client_id, client_secret: str = config.spotify_client_secret, playlist_url: str = spotify_playlist_url
-) -> StorageData:
-    headers = _make_spotify_request_headers(client_id=client_id, client_secret=client_secret)
-    response = requests.get(playlist_url, headers=headers)
+async def _spotify_token_refresher():
+    while True:
+        try:
+            async with _token_lock:
+                if time.monotonic() >= _token_cache[EXPIRES_AT] - TOKEN_EXPIRY_MARGIN:
+                    await _refresh_spotify_token()
+        except Exception as e:
+            logger.error(f"Failed to refresh the Spotify access token with error: {e}")
+            await asyncio.sleep(TOKEN_REFRESH_RETRY_INTERVAL)
+            continue
+        await asyncio.sleep(max(_token_cache[EXPIRES_AT] - time.monotonic() - TOKEN_EXPIRY_MARGIN, TOKEN_REFRESH_RETRY_INTERVAL))
+
+
+@functools.cache
+def _make_spotify_user_url(user_id: str) -> str:
+    return f"https://api.spotify.com/v1/users/{user_id}"
+
+
+@functools.cache
+def _make_playlist_file_key(playlist_name: str) -> str:
+    return f"{playlist_name}.json"
+
+
+async def _spotify_get(url: str, headers: dict, params: dict | None = None) -> httpx.Response:
+    for attempt in range(SPOTIFY_RATE_LIMIT_RETRIES + 1):
+        response = await spotify_client.get(url, headers=headers, params=params)
+        if response.status_code != httpx.codes.TOO_MANY_REQUESTS or attempt == SPOTIFY_RATE_LIMIT_RETRIES:
+            return response
+        retry_after = int(response.headers.get(RETRY_AFTER_HEADER, SPOTIFY_DEFAULT_RETRY_AFTER))
+        logger.warning(f"Spotify API rate limit reached for: {url}, retrying in {retry_after} seconds...")
+        await asyncio.sleep(retry_after)
+
+
+async def get_spotify_playlist_tracks(headers: dict, offset: int, limit: int, playlist_url: str = spotify_playlist_url) -> dict:
+    async with _spotify_pages_semaphore:
+        response = await _spotify_get(
+            f"{playlist_url}/{TRACKS}", headers=headers, params={OFFSET: offset, LIMIT: limit, FIELDS: PLAYLIST_ITEMS_FIELDS}
+        )
     response.raise_for_status()
-    return response.json()
+    return orjson.loads(response.content)
 
 
-def get_spotify_user(user_id: str, client_id: str = config.spotify_client_id, client_secret: str = config.spotify_client_secret) -> dict:
-    headers = _make_spotify_request_headers(client_id=client_id, client_secret=client_secret)
-    response = requests.get(f"https://api.spotify.com/v1/users/{user_id}", headers=headers)
+async def get_spotify_playlist(headers: dict, playlist_url: str = spotify_playlist_url) -> StorageData:
+    response = await _spotify_get(playlist_url, headers=headers, params={FIELDS: PLAYLIST_FIELDS})
     response.raise_for_status()
-    return response.json()
+    playlist = orjson.loads(response.content)
+    tracks = playlist[TRACKS]
+    limit = tracks[LIMIT]
+    pages = await asyncio.gather(
+        *(
+            get_spotify_playlist_tracks(headers=headers, offset=offset, limit=limit, playlist_url=playlist_url)
+            for offset in range(limit, tracks[TOTAL], limit)
+        )
+    )
+    for page in pages:
+        tracks[ITEMS].extend(page[ITEMS])
+    return playlist
+
+
+async def get_spotify_playlist_summary(headers: dict, playlist_url: str = spotify_playlist_url) -> dict:
+    if _playlist_summary_cache[ETAG_HEADER] is not None:
+        headers = {**headers, IF_NONE_MATCH_HEADER: _playlist_summary_cache[ETAG_HEADER]}
+    response = await _spotify_get(playlist_url, headers=headers, params={FIELDS: PLAYLIST_SUMMARY_FIELDS})
+    if response.status_code == httpx.codes.NOT_MODIFIED:
+        return _playlist_summary_cache[PLAYLIST_SUMMARY]
+    response.raise_for_status()
+    _playlist_summary_cache[ETAG_HEADER] = response.headers.get(ETAG_HEADER)
+    _playlist_summary_cache[PLAYLIST_SUMMARY] = orjson.loads(response.content)
+    return _playlist_summary_cache[PLAYLIST_SUMMARY]
+
+
+async def get_spotify_user(user_id: str, headers: dict) -> dict:
+    cached_user = _users_cache.get(user_id)
+    if cached_user is not None and time.monotonic() < cached_user[0]:
+        return cached_user[1]
+    response = await _spotify_get(_make_spotify_user_url(user_id), headers=headers)
+    response.raise_for_status()
+    user = orjson.loads(response.content)
+    _users_cache[user_id] = (time.monotonic() + USER_CACHE_TTL, user)
+    return user
+
+
+def _make_stored_playlist(playlist: dict) -> StorageData:
+    return {
+        NAME: playlist[NAME],
+        ID: playlist[ID],
+        SNAPSHOT_ID: playlist[SNAPSHOT_ID],
+        TRACKS: {ITEMS: [{TRACK: {ID: track[TRACK][ID]}} for track in playlist[TRACKS][ITEMS]]},
+    }
+
+
+@dataclass(frozen=True, slots=True)
+class Track:
+    id: str
+    name: str
+    artists: tuple[str, ...]
+    url: str
+    added_by: str
+
+    @classmethod
+    def from_item(cls, item: dict) -> "Track":
+        track = item[TRACK]
+        return cls(
+            id=track[ID],
+            name=track[NAME],
+            artists=tuple(artist[NAME] for artist in track[ARTISTS]),
+            url=track[EXTERNAL_URLS][SPOTIFY],
+            added_by=item[ADDED_BY][ID],
+        )
+
+
+def _is_legacy_stored_playlist(stored_playlist: dict) -> bool:
+    return EXTERNAL_URLS in stored_playlist or TOTAL in stored_playlist[TRACKS]
 
 
-def get_playlist_tracks(playlist: dict) -> dict:
-    tracks_dict = {}
-    for track in playlist[TRACKS][ITEMS]:
-        tracks_dict[track[TRACK][ID]] = track
-    return tracks_dict
+def _is_truncated_stored_playlist(stored_playlist: dict) -> bool:
+    return len(stored_playlist[TRACKS][ITEMS]) < stored_playlist[TRACKS].get(TOTAL, 0)
 
 
-def compare_playlists_diff(stored_playlist: dict, current_playlist: dict) -> list[dict]:
-    stored_playlist_tracks = get_playlist_tracks(stored_playlist)
-    current_playlist_tracks = get_playlist_tracks(current_playlist)
-    diff_tracks_ids = set(current_playlist_tracks.keys()) - set(stored_playlist_tracks.keys())
-    diff_tracks = []
-    while diff_tracks_ids:
-        track_id = diff_tracks_ids.pop()
-        diff_tracks.append(current_playlist_tracks[track_id])
-    return diff_tracks
+def compare_playlists_diff(stored_playlist: dict, current_playlist: dict) -> list[Track]:
+    stored_tracks_ids = {item[TRACK][ID] for item in stored_playlist[TRACKS][ITEMS]}
+    return [Track.from_item(item) for item in current_playlist[TRACKS][ITEMS] if item[TRACK][ID] not in stored_tracks_ids]
 
 
-def make_chat_message(track: dict, playlist: dict) -> str:
-    track_name = sanitize_text(track[TRACK][NAME])
-    artists_names = [sanitize_text(artist[NAME]) for artist in track[TRACK][ARTISTS]]
-    artists_names = ", ".join(artists_names)
-    added_by = get_spotify_user(user_id=track[ADDED_BY][ID])
-    first_name = added_by[DISPLAY_NAME].partition(" ")[0]
+async def get_spotify_users(user_ids: set[str], headers: dict) -> dict[str, dict]:
+    users = await asyncio.gather(*(get_spotify_user(user_id=user_id, headers=headers) for user_id in user_ids))
+    return dict(zip(user_ids, users))
 
-    return f"""*{first_name}* just added a new track 🥳
 
-*{track_name}* 🎶  [track]({track[TRACK][EXTERNAL_URLS][SPOTIFY]})
+_CHAT_MESSAGE_TEMPLATE = """*{first_name}* just added a new track 🥳
+
+*{track_name}* 🎶  [track]({track_url})
 
 By _{artists_names}_ 🎤
 
-Added to the playlist: {playlist[NAME]}  [playlist]({playlist[EXTERNAL_URLS][SPOTIFY]})
-"""
+Added to the playlist: {playlist_name}  [playlist]({playlist_url})
+""".format
 
 
-async def main():
-    storage_backend = get_storage_backend()
-    spotify_playlist = get_spotify_playlist()
-    logger.info(f"Spotify playlist: {spotify_playlist[NAME]} with ID: {spotify_playlist[ID]}")
+def make_chat_message(track: Track, playlist: dict, user_map: dict[str, dict]) -> str:
+    return _CHAT_MESSAGE_TEMPLATE(
+        first_name=sanitize_text(user_map[track.added_by][DISPLAY_NAME].partition(" ")[0]),
+        track_name=sanitize_text(track.name),
+        track_url=track.url,
+        artists_names=", ".join([sanitize_text(artist) for artist in track.artists]),
+        playlist_name=sanitize_text(playlist[NAME]),
+        playlist_url=playlist[EXTERNAL_URLS][SPOTIFY],
+    )
+
 
-    playlist_file_key = f"{spotify_playlist[NAME]}.json"
+def _get_stored_playlist(storage_backend: Storage, key: str) -> StorageData | None:
     try:
-        stored_playlist: StorageData = storage_backend.get_file(playlist_file_key)
+        return storage_backend.get_file(key)
     except FileNotFound:
-        logger.warning(
-            f"Playlist file does not exist in the storage with name: {playlist_file_key}\n"
-            f"If this is the first run, this is expected. Otherwise, check the storage backend.\n"
-            f"Trying now to store the current playlist..."
-        )
-        stored_playlist = storage_backend.put_file(key=playlist_file_key, data=spotify_playlist)
+        return None
+
+
+async def _migrate_legacy_stored_playlist(
+    storage_backend: Storage, playlist_file_key: str, playlist_summary: dict, spotify_playlist_task: asyncio.Task
+) -> None:
+    spotify_playlist = await spotify_playlist_task
+    if spotify_playlist[SNAPSHOT_ID] == playlist_summary[SNAPSHOT_ID]:
+        logger.info("Migrate the stored playlist from the legacy format...")
+        storage_backend.put_file(key=playlist_file_key, data=_make_stored_playlist(spotify_playlist))
+
+
+async def main():
+    global _last_snapshot_id
+    storage_backend = get_storage_backend()
+    spotify_headers = await _make_spotify_request_headers()
+    playlist_summary = await get_spotify_playlist_summary(headers=spotify_headers)
+    if playlist_summary[SNAPSHOT_ID] == _last_snapshot_id:
+        logger.info("The playlist snapshot has not changed since the last cycle!")
+        return []
+
+    playlist_file_key = _make_playlist_file_key(playlist_summary[NAME])
+    spotify_playlist_task = asyncio.create_task(get_spotify_playlist(headers=spotify_headers))
+    try:
+        stored_playlist = await asyncio.to_thread(_get_stored_playlist, storage_backend, playlist_file_key)
+    except BaseException:
+        spotify_playlist_task.cancel()
+        await asyncio.gather(spotify_playlist_task, return_exceptions=True)
+        raise
+    if stored_playlist is not None:
+        logger.info(f"Stored playlist: {stored_playlist[NAME]} with ID: {stored_playlist[ID]}")
+        if stored_playlist.get(SNAPSHOT_ID) == playlist_summary[SNAPSHOT_ID]:
+            logger.info("The stored playlist snapshot is up to date, skipping the playlist tracks comparison!")
+            if _is_legacy_stored_playlist(stored_playlist):
+                await _migrate_legacy_stored_playlist(storage_backend, playlist_file_key, playlist_summary, spotify_playlist_task)
+            else:
+                spotify_playlist_task.cancel()
+                await asyncio.gather(spotify_playlist_task, return_exceptions=True)
+            _last_snapshot_id = playlist_summary[SNAPSHOT_ID]
+            return []
+
+    spotify_playlist = await spotify_playlist_task
+    logger.info(f"Spotify playlist: {spotify_playlist[NAME]} with ID: {spotify_playlist[ID]}")
 
-    logger.info(f"Stored playlist: {stored_playlist[NAME]} with ID: {stored_playlist[ID]}")
+    if stored_playlist is None or _is_truncated_stored_playlist(stored_playlist):
+        if stored_playlist is None:
+            logger.warning(
+                f"Playlist file does not exist in the storage with name: {playlist_file_key}\n"
+                f"If this is the first run, this is expected. Otherwise, check the storage backend.\n"
+                f"Trying now to store the current playlist..."
+            )
+        else:
+            logger.warning(
+                f"Playlist file: {playlist_file_key} was stored with only the first page of tracks in the legacy format, "
+                f"storing the current playlist as the new baseline without sending chat messages..."
+            )
+        stored_playlist = _make_stored_playlist(spotify_playlist)
+        storage_backend.put_file(key=playlist_file_key, data=stored_playlist)
 
     new_tracks = compare_playlists_diff(stored_playlist=stored_playlist, current_playlist=spotify_playlist)
     notification_tasks = []
-    logger.info("Update the stored playlist with the current playlist...")
-    storage_backend.put_file(key=playlist_file_key, data=spotify_playlist)
+    if stored_playlist.get(SNAPSHOT_ID) != spotify_playlist[SNAPSHOT_ID]:
+        logger.info("Update the stored playlist with the current playlist...")
+        storage_backend.put_file(key=playlist_file_key, data=_make_stored_playlist(spotify_playlist))
+    _last_snapshot_id = spotify_playlist[SNAPSHOT_ID]
 
     if not new_tracks:
         logger.info("No new tracks have been added to the playlist in the last cycle!")
         return notification_tasks
 
+    user_map = await get_spotify_users({new_track.added_by for new_track in new_tracks}, headers=spotify_headers)
+    messages: dict[tuple[str, str, str], str] = {}
     for new_track in new_tracks:
-        logger.info(f"Playlist has been updated with a new track: {new_track[TRACK][NAME]} - Sending a chat message...")
-        notification_tasks.append(send_notification(message=make_chat_message(track=new_track, playlist=spotify_playlist)))
+        logger.info(f"Playlist has been updated with a new track: {new_track.name} - Sending a chat message...")
+        message_key = (new_track.id, new_track.added_by, spotify_playlist[ID])
+        if message_key not in messages:
+            messages[message_key] = make_chat_message(track=new_track, playlist=spotify_playlist, user_map=user_map)
+        notification_tasks.append(send_notification(message=messages[message_key]))
     return notification_tasks
 
 
-if __name__ == "__main__":
-    nest_asyncio.apply()
-    loop = asyncio.get_event_loop()
-    while True:
-        tasks = loop.run_until_complete(main())
-        for task in asyncio.as_completed(tasks):
-            loop.run_until_complete(task)
+async def _cycle():
+    tasks = await main()
+    if tasks:
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Failed to send a chat message with error: {result}")
+
+
+async def runner():
+    try:
+        check_interval = int(config.check_interval)
+    except ValueError:
+        check_interval = 60
+        logger.warning(f"Invalid check interval value: {config.check_interval}. Using the default value of {check_interval} seconds.")
+    async with spotify_client, bot:
+        token_refresher = asyncio.create_task(_spotify_token_refresher())
         try:
-            check_interval = int(config.check_interval)
-        except ValueError:
-            check_interval = 60
-            logger.warning(f"Invalid check interval value: {config.check_interval}. Using the default value of {check_interval} seconds.")
-        logger.info(f"Sleeping for {check_interval} seconds...\n\n")
-        time.sleep(check_interval)
+            while True:
+                await _cycle()
+                logger.info(f"Sleeping for {check_interval} seconds...\n\n")
+                await asyncio.sleep(check_interval)
+        finally:
+            token_refresher.cancel()
+
+
+if __name__ == "__main__":
+    asyncio.run(runner())
@@ -1,7 +1,16 @@
 from typing import TypeAlias
 
+import orjson
+
 
 StorageData: TypeAlias = dict
+EncodedStorageData: TypeAlias = bytes | bytearray | memoryview
+
+
+def encode_storage_data(data: StorageData | EncodedStorageData) -> EncodedStorageData:
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data
+    return orjson.dumps(data)
 
 
 class Storage:
@@ -10,7 +19,7 @@ class Storage:
         raise NotImplementedError
 
     @staticmethod
-    def put_file(key: str, data: StorageData) -> StorageData:
+    def put_file(key: str, data: StorageData | EncodedStorageData) -> StorageData:
         raise NotImplementedError
 
 
@@ -18,5 +27,9 @@ class FileNotFound(Exception):
     pass
 
 
+class ReadFileError(Exception):
+    pass
+
+
 class SaveFileError(Exception):
     pass
@@ -1,7 +1,8 @@
-import json
 import os
 
-from storage import FileNotFound, SaveFileError, Storage, StorageData
+import orjson
+
+from storage import EncodedStorageData, FileNotFound, ReadFileError, SaveFileError, Storage, StorageData, encode_storage_data
 from utils import get_logger, mkdir_p
 
 
@@ -20,23 +21,31 @@ class FilesystemStorage(Storage):
     def get_file(self, key: str) -> StorageData:
         file_path = self._get_file_path(key)
         try:
-            with open(file_path, "r") as file:
-                return json.load(file)
+            with open(file_path, "rb") as file:
+                return orjson.loads(file.read())
         except FileNotFoundError:
             error_message = f"File: {file_path} does not exist in the filesystem"
             raise FileNotFound(error_message)
         except Exception as e:
             error_message = f"Failed to retrieve file with name: {file_path} from the filesystem"
             logger.error(f"{error_message} with error: {e}")
-            raise FileNotFound(error_message)
+            raise ReadFileError(error_message)
 
-    def put_file(self, key: str, data: StorageData) -> StorageData:
+    def put_file(self, key: str, data: StorageData | EncodedStorageData) -> StorageData:
         file_path = self._get_file_path(key)
+        tmp_file_path = f"{file_path}.tmp.{os.getpid()}"
         try:
-            with open(file_path, "w") as file:
-                json.dump(data, file)
-                return data
+            with open(tmp_file_path, "wb") as file:
+                file.write(encode_storage_data(data))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_file_path, file_path)
+            return data
         except Exception as e:
             error_message = f"Failed to store file with name: {file_path} in the filesystem"
             logger.error(f"{error_message} with error: {e}")
+            try:
+                os.remove(tmp_file_path)
+            except FileNotFoundError:
+                pass
             raise SaveFileError(error_message)
@@ -1,9 +1,12 @@
-import io
-import json
+import gzip
+import time
 
 import boto3
+import orjson
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
 
-from storage import FileNotFound, SaveFileError, Storage, StorageData
+from storage import EncodedStorageData, FileNotFound, ReadFileError, SaveFileError, Storage, StorageData, encode_storage_data
 from utils import get_logger
 
 
@@ -13,47 +16,101 @@ logger = get_logger()
 S3 = "s3"
 HTTP_STATUS_CODE = "HTTPStatusCode"
 RESPONSE_METADATA = "ResponseMetadata"
+CONTENT_ENCODING = "ContentEncoding"
+GZIP = "gzip"
+JSON_CONTENT_TYPE = "application/json"
+ETAG = "ETag"
+NOT_MODIFIED = 304
+FILE_CACHE_TTL = 60
+
+_s3_clients = {}
+
+
+def get_s3_client(config):
+    client_key = (config.s3_region, config.s3_access_key_id)
+    if client_key not in _s3_clients:
+        _s3_clients[client_key] = boto3.client(
+            S3,
+            region_name=config.s3_region,
+            aws_access_key_id=config.s3_access_key_id,
+            aws_secret_access_key=config.s3_secret_access_key,
+            config=BotoConfig(max_pool_connections=50, retries={"max_attempts": 5, "mode": "adaptive"}, tcp_keepalive=True),
+        )
+    return _s3_clients[client_key]
 
 
 class S3Storage(Storage):
     def __init__(self, config):
         self.bucket = config.s3_bucket
-        self.client = boto3.client(
-            S3, region_name=config.s3_region, aws_access_key_id=config.s3_access_key_id, aws_secret_access_key=config.s3_secret_access_key
-        )
+        self.client = get_s3_client(config)
+        self._no_such_key = self.client.exceptions.NoSuchKey
+        self._files_cache: dict[str, tuple[float, str | None, StorageData]] = {}
+
+    def _get_object(self, key: str, etag: str | None) -> dict | None:
+        params = {"Bucket": self.bucket, "Key": key}
+        if etag is not None:
+            params["IfNoneMatch"] = etag
+        try:
+            return self.client.get_object(**params)
+        except ClientError as e:
+            if e.response[RESPONSE_METADATA][HTTP_STATUS_CODE] == NOT_MODIFIED:
+                return None
+            raise
 
     def get_file(self, key: str) -> StorageData:
+        cached_file = self._files_cache.get(key)
+        if cached_file is not None and time.monotonic() < cached_file[0]:
+            return cached_file[2]
         try:
-            logger.info(f"Retrieving file with key: {key} from S3 bucket: {self.bucket}")
-            response = self.client.get_object(Bucket=self.bucket, Key=key)
-            data = json.load(response["Body"])
-            logger.info(f"Retrieved file with key: {key} from S3 bucket: {self.bucket}")
+            logger.debug("Retrieving file with key: %s from S3 bucket: %s", key, self.bucket)
+            response = self._get_object(key, cached_file[1] if cached_file is not None else None)
+            if response is None:
+                logger.info("File with key: %s in S3 bucket: %s has not been modified", key, self.bucket)
+                self._files_cache[key] = (time.monotonic() + FILE_CACHE_TTL, cached_file[1], cached_file[2])
+                return cached_file[2]
+            body = response["Body"].read()
+            if response.get(CONTENT_ENCODING) == GZIP:
+                body = gzip.decompress(body)
+            data = orjson.loads(body)
+            self._files_cache[key] = (time.monotonic() + FILE_CACHE_TTL, response.get(ETAG), data)
+            logger.info("Retrieved file with key: %s from S3 bucket: %s", key, self.bucket)
             return data
-        except self.client.exceptions.NoSuchKey:
+        except self._no_such_key:
+            self._files_cache.pop(key, None)
             error_message = f"File: {key} does not exist in the S3 bucket: {self.bucket}"
             logger.error(error_message)
             raise FileNotFound(error_message)
         except Exception as e:
             error_message = f"Failed to retrieve file with key: {key} from S3 bucket: {self.bucket}"
-            logger.error(f"{error_message} with error: {e}")
-            raise FileNotFound(error_message)
+            logger.error("%s with error: %s", error_message, e)
+            raise ReadFileError(error_message)
 
-    def put_file(self, key: str, data: StorageData) -> StorageData:
-        logger.info(f"Storing file: {key} in S3 bucket: {self.bucket} with key: {key}")
+    def put_file(self, key: str, data: StorageData | EncodedStorageData) -> StorageData:
+        logger.debug("Storing file: %s in S3 bucket: %s with key: %s", key, self.bucket, key)
+        self._files_cache.pop(key, None)
         try:
-            file_like_object = io.StringIO()
-            json.dump(obj=data, fp=file_like_object)
-            file_like_object.seek(0)
-            response = self.client.put_object(Body=file_like_object.getvalue().encode(), Bucket=self.bucket, Key=key)
+            body = encode_storage_data(data)
+            response = self.client.put_object(
+                Body=gzip.compress(body, compresslevel=1),
+                Bucket=self.bucket,
+                Key=key,
+                ContentEncoding=GZIP,
+                ContentType=JSON_CONTENT_TYPE,
+            )
             if response[RESPONSE_METADATA][HTTP_STATUS_CODE] == 200:
-                logger.info(f"File with key: {key} stored successfully in S3 bucket: {self.bucket}")
+                cached_data = data if isinstance(data, dict) else orjson.loads(body)
+                self._files_cache[key] = (time.monotonic() + FILE_CACHE_TTL, response.get(ETAG), cached_data)
+                logger.info("File with key: %s stored successfully in S3 bucket: %s", key, self.bucket)
             else:
                 logger.error(
-                    f"Failed to store the file with key: {key} in the S3 bucket: {self.bucket} "
-                    f"with status code: {response[RESPONSE_METADATA][HTTP_STATUS_CODE]} and response: {response}"
+                    "Failed to store the file with key: %s in the S3 bucket: %s with status code: %s and response: %s",
+                    key,
+                    self.bucket,
+                    response[RESPONSE_METADATA][HTTP_STATUS_CODE],
+                    response,
                 )
             return response
         except Exception as e:
             error_message = f"Failed to store file with key: {key} in S3 bucket: {self.bucket}"
-            logger.error(f"{error_message} with error: {e}")
+            logger.error("%s with error: %s", error_message, e)
             raise SaveFileError(error_message)
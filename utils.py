@@ -1,3 +1,4 @@
+import functools
 import logging
 import os
 
@@ -15,22 +16,13 @@ def get_logger():
     return logger
 
 
+_MARKDOWN_ESCAPE_TABLE = str.maketrans({char: f"\\{char}" for char in "\\_*[]()~`>#+-=|{}.!"})
+
+
+@functools.lru_cache(maxsize=4096)
 def sanitize_text(text: str) -> str:
-    return (
-        text.replace(r"_", r"\_")
-        .replace(r"*", r"\*")
-        .replace(r"[", r"\[")
-        .replace(r"`", r"\`")
-        .replace(r"-", r"\-")
-        .replace(r"(", r"\(")
-        .replace(r")", r"\)")
-    )
+    return text.translate(_MARKDOWN_ESCAPE_TABLE)
 
 
 def mkdir_p(path: str) -> None:
-    try:
-        os.makedirs(path)
-    except FileExistsError:
-        pass
-    except Exception as e:
-        raise e
+    os.makedirs(path, exist_ok=True)